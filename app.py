@@ -1,35 +1,122 @@
 import pandas as pd
 import dash
 from dash import dcc, html
-from dash.dependencies import Input, Output
-import plotly.graph_objs as go
+from dash.dependencies import ClientsideFunction, Input, Output
 from pathlib import Path
 import re
 import glob
+from google.auth.transport.requests import Request
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-import io
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+import aiohttp
+import asyncio
 import os
 import json
+import math
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import threading
 
+DRIVE_FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+# Drive accepts at most 100 calls per batch request and 1000 files per page
+DRIVE_MAX_BATCH_SIZE = 100
+DRIVE_PAGE_SIZE = 1000
+DRIVE_MAX_CONNECTIONS = 100
+DRIVE_DOWNLOAD_URL = "https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
+CACHE_FILE = Path("orbit/_cache.parquet")
+# Parquet schema metadata key holding the CSV files the cache was built from
+CACHE_SOURCES_KEY = b"lexi_source_files"
+# Comma-separated allowlist of parameters to load, all parameters are loaded if empty
+PLOT_COLUMNS = [col for col in os.environ.get("LEXI_COLS", "").split(",") if col]
+# Upper bound on the points of one parameter sent to the browser
+MAX_SERIES_POINTS = 200_000
 
-# Utility function to list files recursively from Google Drive
+
+# Utility function to list files recursively from Google Drive, breadth first, with
+# the files.list calls of each folder level sent together in batch requests
 def list_files_recursively(service, folder_id):
     all_files = []
-    query = f"'{folder_id}' in parents and trashed=false"
-    results = (
-        service.files().list(q=query, fields="files(id, name, mimeType)").execute()
-    )
-    files = results.get("files", [])
-    for file in files:
-        if file["mimeType"] == "application/vnd.google-apps.folder":
-            all_files.extend(list_files_recursively(service, file["id"]))
-        else:
-            all_files.append(file)
+    # (folder ID, page token) pairs that still have to be listed
+    pending = [(folder_id, None)]
+
+    def collect(parent_id, request_id, response, exception):
+        if exception is not None:
+            raise exception
+        for file in response.get("files", []):
+            if file["mimeType"] == DRIVE_FOLDER_MIME_TYPE:
+                next_pending.append((file["id"], None))
+            else:
+                all_files.append(file)
+        if "nextPageToken" in response:
+            next_pending.append((parent_id, response["nextPageToken"]))
+
+    while pending:
+        next_pending = []
+        for start in range(0, len(pending), DRIVE_MAX_BATCH_SIZE):
+            batch = service.new_batch_http_request()
+            for parent_id, page_token in pending[start : start + DRIVE_MAX_BATCH_SIZE]:
+                request = service.files().list(
+                    q=f"'{parent_id}' in parents and trashed=false",
+                    fields="nextPageToken, files(id, name, mimeType)",
+                    pageSize=DRIVE_PAGE_SIZE,
+                    pageToken=page_token,
+                )
+                batch.add(request, callback=partial(collect, parent_id))
+            batch.execute()
+        pending = next_pending
     return all_files
 
 
+# Download the raw contents of all files concurrently, one GET request per file
+async def _download_all(file_ids, token):
+    headers = {"Authorization": f"Bearer {token}"}
+    connector = aiohttp.TCPConnector(limit=DRIVE_MAX_CONNECTIONS)
+    async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+
+        async def fetch(file_id):
+            url = DRIVE_DOWNLOAD_URL.format(file_id=file_id)
+            async with session.get(url) as response:
+                response.raise_for_status()
+                return await response.read()
+
+        return await asyncio.gather(*[fetch(file_id) for file_id in file_ids])
+
+
+# Parse a housekeeping CSV file, reading the Date column straight into the index
+def read_hk_csv(source):
+    return pd.read_csv(
+        source,
+        parse_dates=["Date"],
+        date_format="ISO8601",
+        cache_dates=True,
+        index_col="Date",
+    )
+
+
+# Parse the raw contents of a downloaded CSV file into an Arrow table
+def _read_csv_bytes(data):
+    return pa_csv.read_csv(
+        pa.py_buffer(data),
+        read_options=pa_csv.ReadOptions(use_threads=True, block_size=2 << 20),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={"Date": pa.timestamp("ns")},
+            include_columns=["Date"] + PLOT_COLUMNS if PLOT_COLUMNS else None,
+            # Files lacking one of the LEXI_COLS parameters get an all-null column
+            include_missing_columns=True,
+        ),
+    )
+
+
+# Telemetry values do not need double precision for plotting, so store them as float32
+def downcast_floats(df):
+    float_columns = df.select_dtypes("float64").columns
+    df[float_columns] = df[float_columns].astype("float32", copy=False)
+    return df
+
+
 # Function to prepare data from Google Drive
 def prepare_data_from_drive():
     try:
@@ -49,49 +136,108 @@ def prepare_data_from_drive():
         files = [file for file in files if not exclude_pattern.search(file["name"])]
 
         print(f"Found {len(files)} CSV files in the folder.")
-        dataframes = []
-        for i, file in enumerate(files):
-            print(f"Downloading file {i + 1} of {len(files)}: {file['name']}")
-            file_id = file["id"]
-            request = drive_service.files().get_media(fileId=file_id)
-            file_data = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_data, request)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-            file_data.seek(0)
-            df = pd.read_csv(file_data)
-            dataframes.append(df)
-
-        df = pd.concat(dataframes, ignore_index=True)
-        df["Date"] = pd.to_datetime(df["Date"])
+        credentials.refresh(Request())
+        file_ids = [file["id"] for file in files]
+        raw_files = asyncio.run(_download_all(file_ids, credentials.token))
+        tables = [_read_csv_bytes(data) for data in raw_files]
+        del raw_files
+
+        # Columns that are empty in every file are inferred as null, read them as NaN
+        table = pa.concat_tables(tables, promote_options="default")
+        del tables
+        for i, field in enumerate(table.schema):
+            if pa.types.is_null(field.type):
+                table = table.set_column(i, field.name, table[i].cast(pa.float64()))
+
+        # The table is the only owner of its buffers, so the conversion can free them
+        df = table.to_pandas(self_destruct=True, split_blocks=True, use_threads=True)
+        del table
         df.set_index("Date", inplace=True)
-        return df
+        df.sort_index(inplace=True, kind="stable")
+        df = df[~df.index.duplicated(keep="last")]
+        return downcast_floats(df)
 
     except Exception as e:
         print(f"Error preparing data from Google Drive: {e}")
         return pd.DataFrame()
 
 
+# Utility function to list the local CSV files in the orbit folder
+def list_local_csv_files():
+    parent_folder = Path("orbit/")
+    file_name_format = "payload_lexi_*_*_hk_output.csv"
+    csv_files = glob.glob(str(parent_folder / "**" / file_name_format), recursive=True)
+    exclude_pattern = re.compile(r"payload_lexi_\d+_\d+_\d+_\d+_hk_output.csv")
+    return [file for file in csv_files if not exclude_pattern.search(file)]
+
+
+# Parse the local CSV files once and store the combined DataFrame as Parquet
+def build_cache(csv_files=None):
+    if csv_files is None:
+        csv_files = list_local_csv_files()
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        dataframes = list(executor.map(read_hk_csv, csv_files, chunksize=4))
+
+    df = pd.concat(dataframes, copy=False)
+    df.sort_index(inplace=True, kind="stable")
+    df = df[~df.index.duplicated(keep="last")]
+    df = downcast_floats(df)
+
+    # Record the source files, so a deleted or excluded CSV invalidates the cache
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    metadata = dict(table.schema.metadata or {})
+    metadata[CACHE_SOURCES_KEY] = json.dumps(sorted(csv_files)).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    try:
+        pq.write_table(table, CACHE_FILE, compression="zstd")
+    except OSError as e:
+        print(f"Error writing the Parquet cache: {e}")
+    return df
+
+
+# The cache is only reused if it was built from exactly these CSV files and is newer
+# than every one of them
+def cache_is_fresh(csv_files):
+    if not CACHE_FILE.exists():
+        return False
+    metadata = pq.read_schema(CACHE_FILE).metadata or {}
+    if metadata.get(CACHE_SOURCES_KEY) != json.dumps(sorted(csv_files)).encode():
+        return False
+    cache_mtime = os.path.getmtime(CACHE_FILE)
+    return all(os.path.getmtime(file) <= cache_mtime for file in csv_files)
+
+
+# Keep the LEXI_COLS parameters that exist, all parameters are kept if none of them do
+def select_plot_columns(available):
+    if not PLOT_COLUMNS:
+        return None
+    unknown = [col for col in PLOT_COLUMNS if col not in available]
+    if unknown:
+        print(f"Warning: Ignoring unknown parameters in LEXI_COLS: {unknown}")
+    columns = [col for col in PLOT_COLUMNS if col in available]
+    return columns or None
+
+
 # Function to prepare data from local orbit folder
 def prepare_data():
     try:
-        parent_folder = Path("orbit/")
-        file_name_format = "payload_lexi_*_*_hk_output.csv"
-        csv_files = glob.glob(
-            str(parent_folder / "**" / file_name_format), recursive=True
-        )
-        exclude_pattern = re.compile(r"payload_lexi_\d+_\d+_\d+_\d+_hk_output.csv")
-        csv_files = [file for file in csv_files if not exclude_pattern.search(file)]
+        csv_files = list_local_csv_files()
 
         if not csv_files:
             print("No CSV files found in the orbit folder.")
             return pd.DataFrame()
 
-        df = pd.concat([pd.read_csv(file) for file in csv_files], ignore_index=True)
-        df["Date"] = pd.to_datetime(df["Date"])
-        df.set_index("Date", inplace=True)
-        return df
+        # The cache holds every parameter, only the selected ones are loaded from it
+        if cache_is_fresh(csv_files):
+            available = pq.read_schema(CACHE_FILE).names
+            return pd.read_parquet(
+                CACHE_FILE, engine="pyarrow", columns=select_plot_columns(available)
+            )
+        df = build_cache(csv_files)
+        columns = select_plot_columns(df.columns)
+        return df[columns] if columns else df
 
     except Exception as e:
         print(f"Error preparing data from local files: {e}")
@@ -101,70 +247,116 @@ def prepare_data():
 # Initialize Dash App
 app = dash.Dash(__name__)
 
-# Load the data
-df = prepare_data_from_drive() or prepare_data()
-if df.empty:
-    print("Warning: No data available to display.")
+_df = None
+_df_lock = threading.Lock()
+
+
+# Load the data the first time it is needed, so importing the app stays cheap
+def get_df():
+    global _df
+    if _df is None:
+        with _df_lock:
+            if _df is None:
+                df = prepare_data_from_drive()
+                if df.empty:
+                    df = prepare_data()
+                if df.empty:
+                    print("Warning: No data available to display.")
+                _df = df
+    return _df
+
 
 # Layout of the Web Application
-app.layout = html.Div(
-    [
-        html.H1("Interactive Time Series Plot"),
-        html.Label("Select Parameter:"),
-        dcc.Dropdown(
-            id="parameter-dropdown",
-            options=[
-                {"label": col, "value": col} for col in df.columns if col != "Date"
-            ],
-            value=df.columns[0] if not df.empty else None,
-        ),
-        html.Label("Select Time Range:"),
-        dcc.DatePickerRange(
-            id="date-picker-range",
-            start_date=df.index.min().date() if not df.empty else None,
-            end_date=(
-                df.index.max().date() + pd.Timedelta(days=1) if not df.empty else None
+def serve_layout():
+    df = get_df()
+    return html.Div(
+        [
+            html.H1("Interactive Time Series Plot"),
+            html.Label("Select Parameter:"),
+            dcc.Dropdown(
+                id="parameter-dropdown",
+                options=[
+                    {"label": col, "value": col} for col in df.columns if col != "Date"
+                ],
+                value=df.columns[0] if not df.empty else None,
             ),
-            display_format="YYYY-MM-DD",
-            style={"margin": "10px"},
-        ),
+            html.Label("Select Time Range:"),
+            dcc.DatePickerRange(
+                id="date-picker-range",
+                start_date=df.index.min().date() if not df.empty else None,
+                end_date=(
+                    df.index.max().date() + pd.Timedelta(days=1)
+                    if not df.empty
+                    else None
+                ),
+                display_format="YYYY-MM-DD",
+                style={"margin": "10px"},
+            ),
+            dcc.Store(id="series-store"),
+            dcc.Graph(id="time-series-plot"),
+        ]
+    )
+
+
+# Validate the callbacks against the bare components, without loading the data
+app.validation_layout = html.Div(
+    [
+        dcc.Dropdown(id="parameter-dropdown"),
+        dcc.DatePickerRange(id="date-picker-range"),
+        dcc.Store(id="series-store"),
         dcc.Graph(id="time-series-plot"),
     ]
 )
+app.layout = serve_layout
+
 
+# The data is loaded once per process, so each parameter's payload is built only once
+@lru_cache(maxsize=64)
+def series_payload(selected_param):
+    # Long histories are stride-decimated to bound the payload, at the cost of detail
+    # when zooming into a short window of a very long series
+    series = get_df()[selected_param]
+    if len(series) > MAX_SERIES_POINTS:
+        series = series.iloc[:: math.ceil(len(series) / MAX_SERIES_POINTS)]
 
-# Callback to Update Plot
+    t = series.index.asi8 // 1_000_000
+    y = series.to_numpy()
+    # The cached arrays are shared between callbacks, so make them read-only
+    t.setflags(write=False)
+    y.setflags(write=False)
+    return {
+        "name": selected_param,
+        # Milliseconds since the epoch, which Plotly date axes accept directly
+        "t": t,
+        "y": y,
+    }
+
+
+# Callback to send the selected parameter to the browser
 @app.callback(
+    Output("series-store", "data"),
+    Input("parameter-dropdown", "value"),
+)
+def update_series(selected_param):
+    if get_df().empty or not selected_param:
+        return None
+
+    return series_payload(selected_param)
+
+
+# Callback to Update Plot, run in the browser so date changes need no round trip
+app.clientside_callback(
+    ClientsideFunction(namespace="lexi", function_name="update_plot"),
     Output("time-series-plot", "figure"),
     [
-        Input("parameter-dropdown", "value"),
+        Input("series-store", "data"),
         Input("date-picker-range", "start_date"),
         Input("date-picker-range", "end_date"),
     ],
 )
-def update_plot(selected_param, start_date, end_date):
-    if df.empty or not selected_param or not start_date or not end_date:
-        return {}
-
-    mask = (df.index >= start_date) & (df.index <= end_date)
-    filtered_df = df[mask]
-
-    trace = go.Scatter(
-        x=filtered_df.index,
-        y=filtered_df[selected_param],
-        mode="lines",
-        name=selected_param,
-    )
-
-    layout = go.Layout(
-        title=f"Time Series of {selected_param}",
-        xaxis={"title": "Time [UTC]"},
-        yaxis={"title": selected_param},
-        hovermode="closest",
-    )
-
-    return {"data": [trace], "layout": layout}
 
 
 if __name__ == "__main__":
+    # Load the data before serving, so the first page load does not wait for it
+    get_df()
     app.run_server(debug=False, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
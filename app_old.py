@@ -1,17 +1,22 @@
+import numpy as np
 import pandas as pd
 import dash
 from dash import dcc, html
 from dash.dependencies import Input, Output
-import plotly.graph_objs as go
 from pathlib import Path
+from functools import lru_cache
 import re
 import glob
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
 import io
+import math
 import os
 
+# Points beyond this are not visible at screen resolution
+MAX_PLOT_POINTS = 20000
+
 
 def list_files_recursively(service, folder_id):
     """Recursively list all files (including in subfolders) within a given folder."""
@@ -94,6 +99,10 @@ def prepare_data_from_drive():
     df["Date"] = pd.to_datetime(df["Date"])
     df.set_index("Date", inplace=True)
 
+    # Sort by time and drop repeated timestamps, keeping the last
+    df.sort_index(inplace=True, kind="stable")
+    df = df[~df.index.duplicated(keep="last")]
+
     return df
 
 
@@ -113,15 +122,85 @@ def prepare_data():
     df["Date"] = pd.to_datetime(df["Date"])
     df.set_index("Date", inplace=True)
 
+    # Sort by time and drop repeated timestamps, keeping the last
+    df.sort_index(inplace=True, kind="stable")
+    df = df[~df.index.duplicated(keep="last")]
+
     return df
 
 
+def fast_daily_quantiles(values, day_codes, qs=(0.1, 0.5, 0.9)):
+    """Compute the quantiles of each day with a partial sort instead of a full sort."""
+    # Group the rows by day with a single stable sort
+    order = np.argsort(day_codes, kind="stable")
+    values = values[order].reshape(len(order), -1)
+    days, starts = np.unique(day_codes[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+
+    qs = np.asarray(qs)
+    quantiles = np.full((len(days), len(qs), values.shape[1]), np.nan)
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        for j in range(values.shape[1]):
+            group = values[start:end, j]
+            # NaNs are partitioned to the end, so only the first n_valid slots are used
+            n_valid = np.count_nonzero(~np.isnan(group))
+            if n_valid == 0:
+                continue
+            positions = qs * (n_valid - 1)
+            lower = np.floor(positions).astype(int)
+            upper = np.ceil(positions).astype(int)
+            group = np.partition(group, np.union1d(lower, upper))
+            # Linear interpolation between the neighbouring ranks, as in pandas
+            quantiles[i, :, j] = group[lower] + (group[upper] - group[lower]) * (
+                positions - lower
+            )
+
+    return days, quantiles
+
+
+# Precompute the daily median, 10th and 90th percentile of every parameter
+def precompute_daily_stats(df):
+    days, quantiles = fast_daily_quantiles(
+        df.to_numpy(dtype="float64"), df.index.floor("D").asi8, qs=(0.1, 0.5, 0.9)
+    )
+
+    # Columns are keyed by (parameter, statistic)
+    columns = pd.MultiIndex.from_product(
+        [df.columns, ["10th_percentile", "median", "90th_percentile"]]
+    )
+    daily_stats = pd.DataFrame(
+        quantiles.transpose(0, 2, 1).reshape(len(days), -1),
+        index=pd.DatetimeIndex(days, name="Date"),
+        columns=columns,
+    )
+    return daily_stats
+
+
+# The daily stats only depend on the inputs, so recent lookups are kept in memory
+@lru_cache(maxsize=256)
+def _daily_stats(param, start, end):
+    # The raw series stops at end 00:00, so the day starting at end is left out
+    last = pd.Timestamp(end) - pd.Timedelta(1, "ns")
+    daily_stats = daily_stats_all.loc[start:last, param]
+    arrays = (
+        daily_stats["median"].to_numpy(),
+        daily_stats["10th_percentile"].to_numpy(),
+        daily_stats["90th_percentile"].to_numpy(),
+        daily_stats.index.to_numpy(),
+    )
+    # The cached arrays are shared between callbacks, so make them read-only
+    for array in arrays:
+        array.setflags(write=False)
+    return arrays
+
+
 # Step 2: Initialize Dash App
 app = dash.Dash(__name__)
 
 # Load the data
 # df = prepare_data_from_drive()
 df = prepare_data()
+daily_stats_all = precompute_daily_stats(df)
 
 # Step 3: Layout of the Web Application
 app.layout = html.Div(
@@ -162,60 +241,60 @@ app.layout = html.Div(
 )
 def update_plot(selected_param, start_date, end_date):
     # Filter data by selected time range
-    mask = (df.index >= start_date) & (df.index <= end_date)
-    filtered_df = df[mask]
-
-    # Create the plotly figure
-    trace = go.Scatter(
-        x=filtered_df.index,
-        y=filtered_df[selected_param],
-        mode="lines",
-        name=selected_param,
-    )
-
-    # For each day, calculate the median, 10th percentile, and 90th percentile
-    daily_stats = (
-        filtered_df[selected_param]
-        .resample("D")
-        .agg(["median", lambda x: x.quantile(0.1), lambda x: x.quantile(0.9)])
-    )
-
-    # Rename the columns for clarity
-    daily_stats.columns = ["median", "10th_percentile", "90th_percentile"]
-
-    # Add the date as a column for plotting
-    daily_stats["date"] = daily_stats.index
-    daily_stats["date_str"] = daily_stats.index.strftime("%Y-%m-%d")
+    # The index is sorted, so the time range is a slice between two binary searches
+    # Only the selected column is sliced, the rest of the frame is never copied
+    i0 = df.index.searchsorted(pd.Timestamp(start_date), side="left")
+    i1 = df.index.searchsorted(pd.Timestamp(end_date), side="right")
+    series = df[selected_param].iloc[i0:i1]
+    if len(series) > MAX_PLOT_POINTS:
+        series = series.iloc[:: math.ceil(len(series) / MAX_PLOT_POINTS)]
+
+    # Create the plotly figure as plain dicts, which skips Plotly's object validation,
+    # rendered with WebGL as it can hold many points
+    trace = {
+        "type": "scattergl",
+        "x": series.index,
+        "y": series.values,
+        "mode": "lines",
+        "name": selected_param,
+    }
 
-    daily_stats.reset_index(drop=True, inplace=True)
-    trace_avg = go.Scatter(
-        x=daily_stats["date"] + pd.Timedelta(hours=12),
-        y=daily_stats["median"],
-        mode="markers",
-        marker=dict(size=10, color="rgba(0, 0, 0, 1)", symbol="diamond"),
-        name="Daily Average",
-    )
+    # Look up the precomputed daily median, 10th and 90th percentile
+    median, p10, p90, dates = _daily_stats(selected_param, start_date, end_date)
+    x_mid = dates + np.timedelta64(12, "h")
+    lo = median - p10
+    hi = p90 - median
+
+    trace_avg = {
+        "type": "scatter",
+        "x": x_mid,
+        "y": median,
+        "mode": "markers",
+        "marker": dict(size=10, color="rgba(0, 0, 0, 1)", symbol="diamond"),
+        "name": "Daily Average",
+    }
 
-    trace_error = go.Scatter(
-        x=daily_stats["date"] + pd.Timedelta(hours=12),
-        y=daily_stats["median"],
-        error_y=dict(
+    trace_error = {
+        "type": "scatter",
+        "x": x_mid,
+        "y": median,
+        "error_y": dict(
             type="data",
             symmetric=False,
-            array=daily_stats["median"] - daily_stats["10th_percentile"],
-            arrayminus=daily_stats["90th_percentile"] - daily_stats["median"],
+            array=hi,
+            arrayminus=lo,
         ),
-        mode="markers",
-        marker=dict(size=10, color="rgba(255, 0, 0, 0.5)", symbol="circle"),
-        name="10th-90th Percentile",
-    )
+        "mode": "markers",
+        "marker": dict(size=10, color="rgba(255, 0, 0, 0.5)", symbol="circle"),
+        "name": "10th-90th Percentile",
+    }
 
-    layout = go.Layout(
-        title=f"Time Series of {selected_param}",
-        xaxis={"title": "Time [UTC]"},
-        yaxis={"title": selected_param},
-        hovermode="closest",
-    )
+    layout = {
+        "title": {"text": f"Time Series of {selected_param}"},
+        "xaxis": {"title": {"text": "Time [UTC]"}},
+        "yaxis": {"title": {"text": selected_param}},
+        "hovermode": "closest",
+    }
 
     return {
         "data": [trace, trace_avg, trace_error],
@@ -0,0 +1,60 @@
+// Index of the first timestamp at or after `target`, or strictly after it when
+// `right` is set (the equivalent of pandas' searchsorted)
+function bisect(times, target, right) {
+    let lo = 0;
+    let hi = times.length;
+    while (lo < hi) {
+        const mid = (lo + hi) >>> 1;
+        if (times[mid] < target || (right && times[mid] === target)) {
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+// Points beyond this are not visible at screen resolution
+const MAX_PLOT_POINTS = 20000;
+
+// Take every `step`-th element of values[i0:i1]
+function decimate(values, i0, i1, step) {
+    const out = [];
+    for (let i = i0; i < i1; i += step) {
+        out.push(values[i]);
+    }
+    return out;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    lexi: {
+        // Slice the stored series to the selected time range and build the figure
+        update_plot: function (series, startDate, endDate) {
+            if (!series || !startDate || !endDate) {
+                return {};
+            }
+
+            const i0 = bisect(series.t, Date.parse(startDate), false);
+            const i1 = bisect(series.t, Date.parse(endDate), true);
+            const step = Math.max(1, Math.ceil((i1 - i0) / MAX_PLOT_POINTS));
+
+            return {
+                data: [
+                    {
+                        type: "scattergl",
+                        mode: "lines",
+                        name: series.name,
+                        x: decimate(series.t, i0, i1, step),
+                        y: decimate(series.y, i0, i1, step),
+                    },
+                ],
+                layout: {
+                    title: { text: `Time Series of ${series.name}` },
+                    xaxis: { title: { text: "Time [UTC]" }, type: "date" },
+                    yaxis: { title: { text: series.name } },
+                    hovermode: "closest",
+                },
+            };
+        },
+    },
+});